@@ -1,27 +1,75 @@
-import json
 from typing import AsyncIterable, Optional, Any, AsyncGenerator
-from typing import Any, AsyncIterable, Optional
-from dataclasses import dataclass, field
+from dataclasses import dataclass
+from collections import OrderedDict
+import asyncio
+import hashlib
 import re
-from anthropic import AsyncAnthropic, Anthropic
+import threading
+import time
+from anthropic import AsyncAnthropic, Anthropic, DefaultAsyncHttpxClient, DefaultHttpxClient
 from multi_agent_orchestrator.agents import Agent, AgentOptions, AgentStreamResponse
 from multi_agent_orchestrator.types import (ConversationMessage,
                        ParticipantRole,
                        TemplateVariables,
                        AgentProviderType)
-from multi_agent_orchestrator.utils import Logger, AgentTools, AgentTool
+from multi_agent_orchestrator.utils import Logger, AgentTools, AgentTool, SemanticCache
 from multi_agent_orchestrator.retrievers import Retriever
 
+_PLACEHOLDER_RE = re.compile(r"\{\{(\w+)\}\}")
+# Any role other than user is sent to Claude as assistant
+_ROLE_MAP = {ParticipantRole.USER.value: "user"}
+# Number of sessions whose rendered history is kept per agent
+_MESSAGE_CACHE_MAX_SESSIONS = 1000
+_CACHE_CONTROL = {"type": "ephemeral"}
+_CONTEXT_PROMPT = "Here is the context to use to answer the user's question:\n"
+# HTTP clients shared by the agents created with share_http_client, keyed by streaming
+_SHARED_HTTP_CLIENTS: dict[bool, Any] = {}
+_SHARED_HTTP_CLIENTS_LOCK = threading.Lock()
+
+def _compile_template(template: str) -> list[str]:
+    """Split the template into alternating literals and placeholder names."""
+    return _PLACEHOLDER_RE.split(template)
+
+def _render_template(segments: list[str], variables: TemplateVariables) -> str:
+    parts = []
+    for index, segment in enumerate(segments):
+        if index % 2 == 0:
+            parts.append(segment)
+        elif segment in variables:
+            value = variables[segment]
+            parts.append('\n'.join(value) if isinstance(value, list) else str(value))
+        else:
+            parts.append('{{' + segment + '}}')
+    return ''.join(parts)
+
 @dataclass
 class AnthropicAgentOptions(AgentOptions):
     api_key: Optional[str] = None
     client: Optional[Any] = None
+    # HTTP client used when the agent creates its Anthropic client
+    http_client: Optional[Any] = None
+    # Use a connection pool shared with the other agents setting it, when no http_client is given.
+    # The async pool is bound to the event loop that opened its connections and closing
+    # the client of one of these agents closes the pool for all of them
+    share_http_client: bool = False
     model_id: str = "claude-3-5-sonnet-20240620"
     streaming: Optional[bool] = False
+    # Split streamed text events longer than this into smaller chunks, None disables it
+    stream_rechunk_threshold: Optional[int] = None
+    stream_rechunk_size: int = 4
+    stream_rechunk_delay: float = 0.02
     inference_config: Optional[dict[str, Any]] = None
     retriever: Optional[Retriever] = None
+    # Number of retrieval results to keep per agent, 0 disables the cache
+    retriever_cache_max_entries: int = 0
+    # Seconds before a cached retrieval result expires in both caches, None keeps it until evicted
+    retriever_cache_ttl: Optional[float] = None
+    # Serves retrieval results for paraphrased queries, requires an embedding function
+    semantic_cache: Optional[SemanticCache] = None
     tool_config: Optional[dict[str, Any] | AgentTools] = None
     custom_system_prompt: Optional[dict[str, Any]] = None
+    # Mark the system prompt and the conversation as cacheable with Anthropic prompt caching
+    use_prompt_cache: bool = True
 
 
 
@@ -33,6 +81,9 @@ class AnthropicAgent(Agent):
             raise ValueError("Anthropic API key or Anthropic client is required")
 
         self.streaming = options.streaming
+        self.stream_rechunk_threshold = options.stream_rechunk_threshold
+        self.stream_rechunk_size = options.stream_rechunk_size
+        self.stream_rechunk_delay = options.stream_rechunk_delay
 
         if options.client:
             if self.streaming:
@@ -43,13 +94,20 @@ class AnthropicAgent(Agent):
                     raise ValueError("If streaming is disabled, the provided client must be an Anthropic client")
             self.client = options.client
         else:
+            http_client = options.http_client
+            if http_client is None and options.share_http_client:
+                http_client = self._shared_http_client(bool(self.streaming))
             if self.streaming:
-                self.client = AsyncAnthropic(api_key=options.api_key)
+                self.client = AsyncAnthropic(api_key=options.api_key, http_client=http_client)
             else:
-                self.client = Anthropic(api_key=options.api_key)
+                self.client = Anthropic(api_key=options.api_key, http_client=http_client)
 
         self.system_prompt = ''
         self.custom_variables = {}
+        self._system_prompt_dirty = True
+        # Template split into literals and placeholders, reused until prompt_template changes
+        self._compiled_template: list[str] = []
+        self._compiled_template_source: Optional[str] = None
 
         self.default_max_recursions: int = 5
 
@@ -67,8 +125,30 @@ class AnthropicAgent(Agent):
         else:
             self.inference_config = default_inference_config
 
+        # Request fields that stay the same for every call
+        self._base_payload: dict[str, Any] = {
+            "model": self.model_id,
+            "max_tokens": self.inference_config.get('maxTokens'),
+            "temperature": self.inference_config.get('temperature'),
+            "top_p": self.inference_config.get('topP'),
+            "stop_sequences": self.inference_config.get('stopSequences'),
+        }
+
+        self.use_prompt_cache = options.use_prompt_cache
         self.retriever = options.retriever
+        self.retriever_cache_max_entries = options.retriever_cache_max_entries
+        self.retriever_cache_ttl = options.retriever_cache_ttl
+        self.semantic_cache = options.semantic_cache
+        self._retrieval_cache: OrderedDict[bytes, tuple[float, Any]] = OrderedDict()
+        self.retriever_cache_hits = 0
+        self.retriever_cache_misses = 0
+        self._message_cache: OrderedDict[tuple[str, str], list[dict[str, Any]]] = OrderedDict()
         self.tool_config: Optional[dict[str, Any]] = options.tool_config
+        # Claude formatted tools and AgentTools instance, derived from the current tool_config
+        self._tool_config_cache: Optional[Any] = None
+        self._tool_config_cache_source: Optional[dict[str, Any]] = None
+        self._agent_tools: Optional[AgentTools] = None
+        self._sync_tool_config(force=True)
 
         self.prompt_template: str = f"""You are a {self.name}.
         {self.description}
@@ -101,17 +181,90 @@ class AnthropicAgent(Agent):
     def is_streaming_enabled(self) -> bool:
         return self.streaming is True
 
-    async def _prepare_system_prompt(self, input_text: str) -> str:
+    @staticmethod
+    def _shared_http_client(streaming: bool) -> Any:
+        """Return the HTTP client shared by the agents opting in, creating it on first use."""
+        with _SHARED_HTTP_CLIENTS_LOCK:
+            # the sync and async pools are kept apart
+            http_client = _SHARED_HTTP_CLIENTS.get(streaming)
+            if http_client is None or http_client.is_closed:
+                http_client = DefaultAsyncHttpxClient() if streaming else DefaultHttpxClient()
+                _SHARED_HTTP_CLIENTS[streaming] = http_client
+            return http_client
+
+    @staticmethod
+    async def close_shared_http_clients() -> None:
+        """
+        Close the pools used by the agents created with share_http_client,
+        agents created afterwards open new ones.
+        """
+        with _SHARED_HTTP_CLIENTS_LOCK:
+            http_clients = list(_SHARED_HTTP_CLIENTS.items())
+            _SHARED_HTTP_CLIENTS.clear()
+
+        for streaming, http_client in http_clients:
+            if streaming:
+                await http_client.aclose()
+            else:
+                http_client.close()
+
+    async def _prepare_system_prompt(self, input_text: str) -> str | list[dict[str, Any]]:
         """Prepare the system prompt with optional retrieval context."""
 
         self.update_system_prompt()
-        system_prompt = self.system_prompt
 
-        if self.retriever:
+        if not self.retriever:
+            return self.system_prompt
+
+        response = await self._retrieve_context(input_text)
+
+        if self.use_prompt_cache:
+            # Only the static prompt is cached, the context changes with every query
+            return [
+                {"type": "text", "text": self.system_prompt, "cache_control": _CACHE_CONTROL},
+                {"type": "text", "text": f"{_CONTEXT_PROMPT}{response}"}
+            ]
+
+        # build the prompt in one step instead of copying it again on concatenation
+        return f"{self.system_prompt}\n{_CONTEXT_PROMPT}{response}"
+
+    async def _retrieve_context(self, input_text: str) -> Any:
+        """Retrieve the context for the input, serving repeated queries from the caches."""
+
+        use_exact_cache = self.retriever_cache_max_entries > 0
+        if not use_exact_cache and self.semantic_cache is None:
+            return await self.retriever.retrieve_and_combine_results(input_text)
+
+        if use_exact_cache:
+            key = hashlib.sha256(input_text.encode()).digest()
+            cached = self._retrieval_cache.get(key)
+            if cached is not None:
+                stored_at, response = cached
+                if self.retriever_cache_ttl is None or time.monotonic() - stored_at < self.retriever_cache_ttl:
+                    self._retrieval_cache.move_to_end(key)
+                    self.retriever_cache_hits += 1
+                    return response
+                del self._retrieval_cache[key]
+            self.retriever_cache_misses += 1
+
+        vector = None
+        response = None
+        if self.semantic_cache is not None:
+            vector = await self.semantic_cache.embed(input_text)
+            response = self.semantic_cache.get(vector, max_age=self.retriever_cache_ttl)
+
+        if response is None:
             response = await self.retriever.retrieve_and_combine_results(input_text)
-            system_prompt += f"\nHere is the context to use to answer the user's question:\n{response}"
+            if vector is not None:
+                self.semantic_cache.put(vector, response)
+
+        if use_exact_cache:
+            self._retrieval_cache[key] = (time.monotonic(), response)
+            self._retrieval_cache.move_to_end(key)
+            while len(self._retrieval_cache) > self.retriever_cache_max_entries:
+                self._retrieval_cache.popitem(last=False)
 
-        return system_prompt
+        return response
 
     def _prepare_conversation(
         self,
@@ -120,12 +273,44 @@ class AnthropicAgent(Agent):
     ) -> list[Any]:
         """Prepare the conversation history with the new user message."""
 
-        messages = [{"role": "user" if msg.role == ParticipantRole.USER.value else "assistant",
-                     "content": msg.content[0]['text'] if msg.content else ''} for msg in chat_history]
+        messages = [self._to_claude_message(msg) for msg in chat_history]
         messages.append({"role": "user", "content": input_text})
 
         return messages
 
+    def _prepare_session_conversation(
+        self,
+        input_text: str,
+        user_id: str,
+        session_id: str,
+        chat_history: list[ConversationMessage]
+    ) -> list[Any]:
+        """Prepare the conversation, only converting the history messages added since the last request."""
+
+        key = (user_id, session_id)
+        cached = self._message_cache.get(key)
+
+        # The history is append-only between turns unless it was trimmed or replaced,
+        # in which case the cached messages no longer line up with it
+        if not cached or len(chat_history) <= len(cached) \
+                or cached[0] != self._to_claude_message(chat_history[0]) \
+                or cached[-1] != self._to_claude_message(chat_history[len(cached) - 1]):
+            cached = []
+
+        cached.extend(self._to_claude_message(msg) for msg in chat_history[len(cached):])
+
+        self._message_cache[key] = cached
+        self._message_cache.move_to_end(key)
+        if len(self._message_cache) > _MESSAGE_CACHE_MAX_SESSIONS:
+            self._message_cache.popitem(last=False)
+
+        return [*cached, {"role": "user", "content": input_text}]
+
+    @staticmethod
+    def _to_claude_message(msg: ConversationMessage) -> dict[str, Any]:
+        return {"role": _ROLE_MAP.get(msg.role, "assistant"),
+                "content": msg.content[0]['text'] if msg.content else ''}
+
     def _prepare_tool_config(self) -> dict:
         """Prepare tool configuration based on the tool type."""
 
@@ -140,27 +325,65 @@ class AnthropicAgent(Agent):
 
         raise RuntimeError("Invalid tool config")
 
+    def _sync_tool_config(self, force: bool = False) -> None:
+        """Drop what was derived from tool_config when it has been replaced."""
+
+        if not force and self._tool_config_cache_source is self.tool_config:
+            return
+        tool = (self.tool_config or {}).get('tool')
+        self._tool_config_cache = None
+        self._tool_config_cache_source = self.tool_config
+        self._agent_tools = tool if isinstance(tool, AgentTools) else None
+
+    def _get_tool_config(self) -> Any:
+        """Return the formatted tools, formatting them only when tool_config has been replaced."""
+
+        self._sync_tool_config()
+        if self._tool_config_cache is None:
+            self._tool_config_cache = self._prepare_tool_config()
+        return self._tool_config_cache
+
+    def refresh_tool_cache(self) -> None:
+        """Format the tools again on the next request, after they were modified in place."""
+        self._sync_tool_config(force=True)
+
     def _build_input(
             self,
             messages: list[Any],
-            system_prompt: str
+            system_prompt: str | list[dict[str, Any]]
             ) -> dict:
         """Build the conversation command with all necessary configurations."""
-        input = {
-            "model": self.model_id,
-            "max_tokens": self.inference_config.get('maxTokens'),
-            "messages": messages,
-            "system": system_prompt,
-            "temperature": self.inference_config.get('temperature'),
-            "top_p": self.inference_config.get('topP'),
-            "stop_sequences": self.inference_config.get('stopSequences'),
-        }
+        input = self._base_payload.copy()
+        input["messages"] = messages
+        input["system"] = system_prompt
+
+        if self.use_prompt_cache:
+            # Tool rounds resend the whole conversation, the cache breakpoints let
+            # Anthropic reuse the processed prefix instead of computing it again
+            if isinstance(system_prompt, str):
+                input["system"] = [{"type": "text", "text": system_prompt, "cache_control": _CACHE_CONTROL}]
+            if messages:
+                # the caller's list is left untouched
+                input["messages"] = [*messages[:-1], self._with_cache_control(messages[-1])]
 
         if self.tool_config:
-            input["tools"] = self._prepare_tool_config()
+            input["tools"] = self._get_tool_config()
 
         return input
 
+    @staticmethod
+    def _with_cache_control(message: dict[str, Any]) -> dict[str, Any]:
+        """Return a copy of the message with a cache breakpoint on its last content block."""
+        content = message["content"]
+        if not content:
+            return message
+        if isinstance(content, str):
+            blocks = [{"type": "text", "text": content}]
+        else:
+            blocks = [*content]
+        blocks[-1] = {**blocks[-1], "cache_control": _CACHE_CONTROL}
+        return {**message, "content": blocks}
+
     def _get_max_recursions(self) -> int:
         """Get the maximum number of recursions based on tool configuration."""
         if not self.tool_config:
@@ -174,33 +397,58 @@ class AnthropicAgent(Agent):
         max_recursions: int
     ) -> AsyncIterable[Any]:
         """Handle streaming response processing with tool recursion."""
-        continue_with_tools = True
-        final_response = None
-
-        async def stream_generator():
-            nonlocal continue_with_tools, final_response, max_recursions
-
-            while continue_with_tools and max_recursions > 0:
-                response = self.handle_streaming_response(input)
-
-                async for chunk in response:
-                    if chunk.final_message:
-                        final_response = chunk.final_message # do not yield the full message as it need to be converted in Conversation Message
-                    else:
-                        yield chunk
-
-                if any('tool_use' in content.type for content in final_response.content):
-                    input['messages'].append({"role": "assistant", "content": final_response.content})
-                    tool_response = await self._process_tool_block(final_response, messages)
-                    input['messages'].append(tool_response)
-                else:
-                    continue_with_tools = False
-                    # yield las message
-                    yield AgentStreamResponse(final_message=ConversationMessage(role=ParticipantRole.ASSISTANT.value, content=[{"text": final_response.content[0].text}]))
+        return self._stream_with_tools(input, messages, max_recursions)
 
-                max_recursions -= 1
+    async def _stream_with_tools(
+        self,
+        input: dict,
+        messages: list[Any],
+        max_recursions: int,
+        keep_content_blocks: bool = False
+    ) -> AsyncGenerator[AgentStreamResponse, None]:
+        """Stream the response and the tool rounds, reading the Anthropic stream directly."""
+        on_llm_new_token = self.callbacks.on_llm_new_token
+        final_response = None
 
-        return stream_generator()
+        for remaining in range(max(max_recursions, 1), 0, -1):
+            try:
+                async with self.client.messages.stream(**input) as stream:
+                    async for event in stream:
+                        if event.type == "text":
+                            if self.stream_rechunk_threshold is not None and len(event.text) > self.stream_rechunk_threshold:
+                                async for chunk in self._rechunk_text(event.text):
+                                    on_llm_new_token(chunk)
+                                    yield AgentStreamResponse(text=chunk)
+                            else:
+                                on_llm_new_token(event.text)
+                                yield AgentStreamResponse(text=event.text)
+                        elif event.type == "content_block_stop":
+                            break
+
+                    # you can still get the accumulated final message outside of
+                    # the context manager, as long as the entire stream was consumed
+                    # inside of the context manager
+                    final_response = await stream.get_final_message()
+
+            except Exception as error:
+                Logger.error(f"Error getting stream from Anthropic model: {str(error)}")
+                raise error
+
+            # the tool result could not be sent back once the last call is spent
+            if remaining == 1 or not self._has_tool_use(final_response):
+                break
+
+            input['messages'].append({"role": "assistant", "content": final_response.content})
+            tool_response = await self._process_tool_block(final_response, messages)
+            input['messages'].append(tool_response)
+
+        if keep_content_blocks:
+            # the whole content is kept so callers still see the tool use blocks
+            final_message = ConversationMessage(role=ParticipantRole.ASSISTANT.value,
+                                                content=final_response.content)
+        else:
+            final_message = self._to_conversation_message(final_response)
+        yield AgentStreamResponse(final_message=final_message)
 
     async def _process_with_strategy(
         self,
@@ -217,16 +465,15 @@ class AnthropicAgent(Agent):
         return await self._handle_single_response_loop(input, messages, max_recursions)
 
     async def _process_tool_block(self, llm_response: Any, conversation: list[Any]) -> (Any):
-        if 'useToolHandler' in  self.tool_config:
+        if 'useToolHandler' in self.tool_config:
             # tool process logic is handled elsewhere
-            tool_response = await self.tool_config['useToolHandler'](llm_response, conversation)
-        else:
-            # tool process logic is handled in AgentTools class
-            if isinstance(self.tool_config['tool'], AgentTools):
-                tool_response = await self.tool_config['tool'].tool_handler(AgentProviderType.ANTHROPIC.value, llm_response, conversation)
-            else:
-                raise ValueError("You must use class when not providing a custom tool handler")
-        return tool_response
+            return await self.tool_config['useToolHandler'](llm_response, conversation)
+
+        self._sync_tool_config()
+        if self._agent_tools is None:
+            raise ValueError("You must use class when not providing a custom tool handler")
+        # tool process logic is handled in AgentTools class
+        return await self._agent_tools.tool_handler(AgentProviderType.ANTHROPIC.value, llm_response, conversation)
 
     async def _handle_single_response_loop(
         self,
@@ -236,21 +483,28 @@ class AnthropicAgent(Agent):
     ) -> ConversationMessage:
         """Handle single response processing with tool recursion."""
 
-        continue_with_tools = True
         llm_response = None
 
-        while continue_with_tools and max_recursions > 0:
+        for remaining in range(max(max_recursions, 1), 0, -1):
             llm_response = await self.handle_single_response(input)
-            if any('tool_use' in content.type for content in llm_response.content):
-                input['messages'].append({"role": "assistant", "content": llm_response.content})
-                tool_response = await self._process_tool_block(llm_response, messages)
-                input['messages'].append(tool_response)
-            else:
-                continue_with_tools = False
+            if remaining == 1 or not self._has_tool_use(llm_response):
+                break
 
-            max_recursions -= 1
+            input['messages'].append({"role": "assistant", "content": llm_response.content})
+            tool_response = await self._process_tool_block(llm_response, messages)
+            input['messages'].append(tool_response)
 
-        return ConversationMessage(role=ParticipantRole.ASSISTANT.value, content=[{"text": llm_response.content[0].text}])
+        return self._to_conversation_message(llm_response)
+
+    @staticmethod
+    def _has_tool_use(llm_response: Any) -> bool:
+        return any(content.type == "tool_use" for content in llm_response.content)
+
+    @staticmethod
+    def _to_conversation_message(llm_response: Any) -> ConversationMessage:
+        # a response ending the tool budget may only hold tool use blocks
+        text = next((content.text for content in llm_response.content if content.type == "text"), "")
+        return ConversationMessage(role=ParticipantRole.ASSISTANT.value, content=[{"text": text}])
 
     async def process_request(
         self,
@@ -261,50 +515,46 @@ class AnthropicAgent(Agent):
         additional_params: Optional[dict[str, str]] = None
     ) -> ConversationMessage | AsyncIterable[Any]:
 
-        messages = self._prepare_conversation(input_text, chat_history)
-        system_prompt = await self._prepare_system_prompt(input_text)
+        if self.retriever:
+            # Start the retrieval first so its request is in flight while the conversation is prepared
+            system_prompt_task = asyncio.create_task(self._prepare_system_prompt(input_text))
+            try:
+                await asyncio.sleep(0)
+                messages = self._prepare_session_conversation(input_text, user_id, session_id, chat_history)
+            except BaseException:
+                # also on cancellation, otherwise the retrieval keeps running unawaited
+                system_prompt_task.cancel()
+                raise
+            system_prompt = await system_prompt_task
+        else:
+            messages = self._prepare_session_conversation(input_text, user_id, session_id, chat_history)
+            system_prompt = await self._prepare_system_prompt(input_text)
+
         input = self._build_input(messages, system_prompt)
 
-        return await self._process_with_strategy(self.streaming, input, messages)
+        # tool handlers get the payload conversation to see the rounds appended to it
+        return await self._process_with_strategy(self.streaming, input, input["messages"])
 
     async def handle_single_response(self, input_data: dict) -> Any:
         try:
-            response = self.client.messages.create(**input_data)
-            return response
+            # the sync client would block the event loop for the whole request
+            return await asyncio.to_thread(self.client.messages.create, **input_data)
         except Exception as error:
             Logger.error(f"Error invoking Anthropic: {error}")
             raise error
 
     async def handle_streaming_response(self, input) -> AsyncGenerator[AgentStreamResponse, None]:
-        message = {}
-        content = []
-        accumulated = {}
-        message['content'] = content
-
-        try:
-            async with self.client.messages.stream(**input) as stream:
-                async for event in stream:
-                    if event.type == "text":
-                        self.callbacks.on_llm_new_token(event.text)
-                        yield AgentStreamResponse(text=event.text)
-                    elif event.type == "content_block_stop":
-                        recursions = 0
-                        break
-
-                # you can still get the accumulated final message outside of
-                # the context manager, as long as the entire stream was consumed
-                # inside of the context manager
-
-                accumulated = await stream.get_final_message()
-            # we need to yield the whole content to keep the tool use block
-            yield AgentStreamResponse(
-                final_message=ConversationMessage(role=ParticipantRole.ASSISTANT.value,
-                                                  content=accumulated.content))
-
-        except Exception as error:
-            Logger.error(f"Error getting stream from Anthropic model: {str(error)}")
-            raise error
-
+        """Stream a single response without tool rounds."""
+        async for chunk in self._stream_with_tools(input, [], 1, keep_content_blocks=True):
+            yield chunk
+
+    async def _rechunk_text(self, text: str) -> AsyncGenerator[str, None]:
+        """Split an oversized stream event into small chunks paced like regular tokens."""
+        size = max(self.stream_rechunk_size, 1)
+        for start in range(0, len(text), size):
+            if start:
+                await asyncio.sleep(self.stream_rechunk_delay)
+            yield text[start:start + size]
 
     def set_system_prompt(self,
                           template: Optional[str] = None,
@@ -313,19 +563,22 @@ class AnthropicAgent(Agent):
             self.prompt_template = template
         if variables:
             self.custom_variables = variables
+        self._system_prompt_dirty = True
         self.update_system_prompt()
 
     def update_system_prompt(self) -> None:
+        # The rendered prompt only changes through set_system_prompt
+        if not self._system_prompt_dirty:
+            return
+        if self._compiled_template_source is not self.prompt_template:
+            self._compiled_template = _compile_template(self.prompt_template)
+            self._compiled_template_source = self.prompt_template
         all_variables: TemplateVariables = {**self.custom_variables}
-        self.system_prompt = self.replace_placeholders(self.prompt_template, all_variables)
+        self.system_prompt = _render_template(self._compiled_template, all_variables)
+        self._system_prompt_dirty = False
 
     @staticmethod
     def replace_placeholders(template: str, variables: TemplateVariables) -> str:
-        def replace(match):
-            key = match.group(1)
-            if key in variables:
-                value = variables[key]
-                return '\n'.join(value) if isinstance(value, list) else str(value)
-            return match.group(0)
-
-        return re.sub(r'{{(\w+)}}', replace, template)
+        if "{{" not in template:
+            return template
+        return _render_template(_compile_template(template), variables)
@@ -2,6 +2,7 @@
 from .helpers import is_tool_input, conversation_to_dict
 from .logger import Logger
 from .tool import AgentTool, AgentTools
+from .semantic_cache import SemanticCache
 
 __all__ = [
     'is_tool_input',
@@ -9,4 +10,5 @@ __all__ = [
     'Logger',
     'AgentTool',
     'AgentTools',
+    'SemanticCache',
 ]
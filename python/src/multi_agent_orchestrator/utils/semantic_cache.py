@@ -0,0 +1,163 @@
+"""
+Semantic cache backed by random-projection locality-sensitive hashing.
+"""
+from typing import Any, Awaitable, Callable, Optional, Union
+from collections import OrderedDict
+import inspect
+import math
+import random
+import time
+
+EmbeddingFunction = Callable[[str], Union[list[float], Awaitable[list[float]]]]
+
+class SemanticCache:
+    """
+    Cache that returns a stored value for vectors close to a previously stored one.
+
+    Vectors are bucketed with random hyperplane projections (one signature per
+    hash table), so a lookup only compares the query against the entries sharing
+    a bucket with it. A candidate is a hit when its cosine similarity with the
+    query reaches the threshold.
+    """
+
+    def __init__(self,
+                 dimensions: int,
+                 embedding_function: Optional[EmbeddingFunction] = None,
+                 threshold: float = 0.95,
+                 num_tables: int = 4,
+                 num_planes: int = 8,
+                 max_entries: int = 1000,
+                 seed: Optional[int] = None):
+        """
+        Args:
+            dimensions: Size of the vectors stored in the cache.
+            embedding_function: Sync or async callable turning a text into a vector,
+                required to use `embed`.
+            threshold: Minimum cosine similarity for a lookup to be a hit.
+            num_tables: Number of hash tables, more tables increase recall.
+            num_planes: Number of hyperplanes per table, more planes increase precision.
+            max_entries: Maximum number of entries, the oldest ones are evicted first.
+            seed: Optional seed for the random projections.
+        """
+        if dimensions <= 0:
+            raise ValueError("dimensions must be a positive integer")
+
+        self.dimensions = dimensions
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        rng = random.Random(seed)
+        self._tables: list[list[list[float]]] = [
+            [[rng.gauss(0.0, 1.0) for _ in range(dimensions)] for _ in range(num_planes)]
+            for _ in range(num_tables)
+        ]
+        self._buckets: list[dict[int, list[int]]] = [{} for _ in range(num_tables)]
+        self._entries: OrderedDict[int, tuple[list[int], list[float], float, float, Any]] = OrderedDict()
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def embed(self, text: str) -> list[float]:
+        """Embed the text with the configured embedding function."""
+        if self.embedding_function is None:
+            raise ValueError("An embedding function is required to embed text")
+        vector = self.embedding_function(text)
+        if inspect.isawaitable(vector):
+            vector = await vector
+        return vector
+
+    def get(self,
+            vector: list[float],
+            threshold: Optional[float] = None,
+            max_age: Optional[float] = None) -> Optional[Any]:
+        """
+        Return the value of the most similar entry above the threshold, or None.
+        Entries stored more than `max_age` seconds ago are expired and removed.
+        """
+        if len(vector) != self.dimensions:
+            raise ValueError(f"Expected a vector of {self.dimensions} dimensions, got {len(vector)}")
+
+        norm = self._norm(vector)
+        if norm == 0.0:
+            self.misses += 1
+            return None
+
+        threshold = self.threshold if threshold is None else threshold
+        best_value = None
+        best_similarity = threshold
+        seen: set[int] = set()
+        expired: list[int] = []
+        now = time.monotonic()
+
+        for buckets, signature in zip(self._buckets, self._signatures(vector)):
+            for entry_id in buckets.get(signature, ()):
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                _, entry_vector, entry_norm, stored_at, value = self._entries[entry_id]
+                if max_age is not None and now - stored_at >= max_age:
+                    expired.append(entry_id)
+                    continue
+                similarity = sum(a * b for a, b in zip(vector, entry_vector)) / (norm * entry_norm)
+                if similarity >= best_similarity:
+                    best_similarity = similarity
+                    best_value = value
+
+        for entry_id in expired:
+            self._remove(entry_id)
+
+        if best_value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return best_value
+
+    def put(self, vector: list[float], value: Any) -> None:
+        """Store the value for the vector, evicting the oldest entry when full."""
+        if len(vector) != self.dimensions:
+            raise ValueError(f"Expected a vector of {self.dimensions} dimensions, got {len(vector)}")
+
+        norm = self._norm(vector)
+        if norm == 0.0:
+            return
+
+        entry_id = self._next_id
+        self._next_id += 1
+        signatures = self._signatures(vector)
+        for buckets, signature in zip(self._buckets, signatures):
+            buckets.setdefault(signature, []).append(entry_id)
+        self._entries[entry_id] = (signatures, list(vector), norm, time.monotonic(), value)
+
+        while len(self._entries) > self.max_entries:
+            self._remove(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        """Remove all entries from the cache."""
+        self._entries.clear()
+        for buckets in self._buckets:
+            buckets.clear()
+
+    def _remove(self, entry_id: int) -> None:
+        signatures = self._entries.pop(entry_id)[0]
+        for buckets, signature in zip(self._buckets, signatures):
+            bucket = buckets[signature]
+            bucket.remove(entry_id)
+            if not bucket:
+                del buckets[signature]
+
+    def _signatures(self, vector: list[float]) -> list[int]:
+        signatures = []
+        for planes in self._tables:
+            signature = 0
+            for plane in planes:
+                signature = (signature << 1) | (sum(a * b for a, b in zip(vector, plane)) >= 0.0)
+            signatures.append(signature)
+        return signatures
+
+    @staticmethod
+    def _norm(vector: list[float]) -> float:
+        return math.sqrt(sum(value * value for value in vector))
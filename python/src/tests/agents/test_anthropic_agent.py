@@ -1,10 +1,12 @@
+import asyncio
 import pytest
 from unittest.mock import patch, MagicMock, AsyncMock, call
 from multi_agent_orchestrator.types import ConversationMessage, ParticipantRole
 from multi_agent_orchestrator.agents import AnthropicAgent, AnthropicAgentOptions
-from multi_agent_orchestrator.utils import Logger, AgentTools, AgentTool
+from multi_agent_orchestrator.utils import Logger, AgentTools, AgentTool, SemanticCache
 from multi_agent_orchestrator.retrievers import Retriever
-from anthropic import Anthropic, AsyncAnthropic
+from anthropic import Anthropic, AsyncAnthropic, DefaultHttpxClient
+from anthropic.types import ToolUseBlock
 from multi_agent_orchestrator.types import AgentProviderType
 
 logger = Logger()
@@ -14,6 +16,31 @@ def mock_anthropic():
     with patch('multi_agent_orchestrator.agents.anthropic_agent.AnthropicAgentOptions.client') as mock:
         yield mock
 
+class MockAnthropicStream:
+    """Stands in for client.messages.stream, streaming texts then returning the final content."""
+
+    def __init__(self, texts, final_content):
+        self.events = iter([type('Event', (), {'type': 'text', 'text': text}) for text in texts])
+        self.final_content = final_content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.events)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def get_final_message(self):
+        return MagicMock(content=self.final_content)
+
 # Existing tests
 
 def test_no_api_key_init(mock_anthropic):
@@ -162,7 +189,7 @@ async def test_process_request_single_response():
     with patch('anthropic.Anthropic') as MockAnthropic:
         # Setup the mock instance that will be created
         mock_instance = MagicMock()
-        mock_instance.messages.create.return_value = MagicMock(content=[MagicMock(text="Test response")])
+        mock_instance.messages.create.return_value = MagicMock(content=[MagicMock(type="text", text="Test response")])
         MockAnthropic.return_value = mock_instance
 
         options = AnthropicAgentOptions(
@@ -181,8 +208,8 @@ async def test_process_request_single_response():
         mock_instance.messages.create.assert_called_once_with(
             model='claude-3-sonnet-20240229',
             max_tokens=1000,
-            messages=[{'role': 'user', 'content': 'Test prompt'}],
-            system="You are a TestAgent.\n        A test agent\n        Provide helpful and accurate information based on your expertise.\n        You will engage in an open-ended conversation,\n        providing helpful and accurate information based on your expertise.\n        The conversation will proceed as follows:\n        - The human may ask an initial question or provide a prompt on any topic.\n        - You will provide a relevant and informative response.\n        - The human may then follow up with additional questions or prompts related to your previous\n        response, allowing for a multi-turn dialogue on that topic.\n        - Or, the human may switch to a completely new and unrelated topic at any point.\n        - You will seamlessly shift your focus to the new topic, providing thoughtful and\n        coherent responses based on your broad knowledge base.\n        Throughout the conversation, you should aim to:\n        - Understand the context and intent behind each new question or prompt.\n        - Provide substantive and well-reasoned responses that directly address the query.\n        - Draw insights and connections from your extensive knowledge when appropriate.\n        - Ask for clarification if any part of the question or prompt is ambiguous.\n        - Maintain a consistent, respectful, and engaging tone tailored\n        to the human's communication style.\n        - Seamlessly transition between topics as the human introduces new subjects.",
+            messages=[{'role': 'user', 'content': [{'type': 'text', 'text': 'Test prompt', 'cache_control': {'type': 'ephemeral'}}]}],
+            system=[{'type': 'text', 'cache_control': {'type': 'ephemeral'}, 'text': "You are a TestAgent.\n        A test agent\n        Provide helpful and accurate information based on your expertise.\n        You will engage in an open-ended conversation,\n        providing helpful and accurate information based on your expertise.\n        The conversation will proceed as follows:\n        - The human may ask an initial question or provide a prompt on any topic.\n        - You will provide a relevant and informative response.\n        - The human may then follow up with additional questions or prompts related to your previous\n        response, allowing for a multi-turn dialogue on that topic.\n        - Or, the human may switch to a completely new and unrelated topic at any point.\n        - You will seamlessly shift your focus to the new topic, providing thoughtful and\n        coherent responses based on your broad knowledge base.\n        Throughout the conversation, you should aim to:\n        - Understand the context and intent behind each new question or prompt.\n        - Provide substantive and well-reasoned responses that directly address the query.\n        - Draw insights and connections from your extensive knowledge when appropriate.\n        - Ask for clarification if any part of the question or prompt is ambiguous.\n        - Maintain a consistent, respectful, and engaging tone tailored\n        to the human's communication style.\n        - Seamlessly transition between topics as the human introduces new subjects."}],
             temperature=0.1,
             top_p=0.9,
             stop_sequences=[]
@@ -234,6 +261,38 @@ def test_streaming(mock_anthropic):
     _anthropic_llm_agent = AnthropicAgent(options)
     assert(_anthropic_llm_agent.is_streaming_enabled() == False)
 
+@pytest.mark.asyncio
+async def test_shared_http_client():
+    def create_agent(**kwargs):
+        return AnthropicAgent(AnthropicAgentOptions(
+            api_key='test-api-key',
+            name="TestAgent",
+            description="A test agent",
+            **kwargs
+        ))
+
+    # Each agent gets its own pool by default
+    assert create_agent().client._client is not create_agent().client._client
+    assert create_agent(streaming=True).client._client is not create_agent(streaming=True).client._client
+
+    first, second = create_agent(share_http_client=True), create_agent(share_http_client=True)
+    assert first.client._client is second.client._client
+
+    first_streaming = create_agent(streaming=True, share_http_client=True)
+    second_streaming = create_agent(streaming=True, share_http_client=True)
+    assert first_streaming.client._client is second_streaming.client._client
+    assert first_streaming.client._client is not first.client._client
+
+    custom_http_client = DefaultHttpxClient()
+    assert create_agent(http_client=custom_http_client, share_http_client=True).client._client is custom_http_client
+    custom_http_client.close()
+
+    shared = first.client._client
+    await AnthropicAgent.close_shared_http_clients()
+    assert shared.is_closed
+    assert first_streaming.client._client.is_closed
+    assert create_agent(share_http_client=True).client._client is not shared
+
 # New tests to improve coverage
 
 @pytest.mark.asyncio
@@ -253,7 +312,18 @@ async def test_prepare_system_prompt_with_retriever():
     system_prompt = await anthropic_agent._prepare_system_prompt("Test query")
 
     mock_retriever.retrieve_and_combine_results.assert_called_once_with("Test query")
-    assert "Retrieved context" in system_prompt
+    # the static prompt is cached on its own, the retrieved context follows uncached
+    assert system_prompt == [
+        {"type": "text", "text": anthropic_agent.system_prompt, "cache_control": {"type": "ephemeral"}},
+        {"type": "text", "text": "Here is the context to use to answer the user's question:\nRetrieved context"}
+    ]
+
+    anthropic_agent.use_prompt_cache = False
+    system_prompt = await anthropic_agent._prepare_system_prompt("Test query")
+    assert system_prompt == f"{anthropic_agent.system_prompt}\nHere is the context to use to answer the user's question:\nRetrieved context"
+
+    input_data = anthropic_agent._build_input([{"role": "user", "content": "Test query"}], system_prompt)
+    assert input_data["system"] == system_prompt
 
 @pytest.mark.asyncio
 async def test_prepare_conversation():
@@ -352,8 +422,10 @@ def test_build_input():
 
     assert input_data["model"] == "claude-3-5-sonnet-20240620"
     assert input_data["max_tokens"] == 1000
-    assert input_data["messages"] == messages
-    assert input_data["system"] == system_prompt
+    assert input_data["messages"] == [
+        {"role": "user", "content": [{"type": "text", "text": "Test message", "cache_control": {"type": "ephemeral"}}]}
+    ]
+    assert input_data["system"] == [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
     assert input_data["temperature"] == 0.1
     assert input_data["top_p"] == 0.9
     assert input_data["stop_sequences"] == []
@@ -482,8 +554,7 @@ async def test_handle_single_response_with_tools():
 
 @pytest.mark.asyncio
 async def test_handle_streaming_response():
-    """Test the streaming response functionality by directly patching the method."""
-    from multi_agent_orchestrator.agents.anthropic_agent import AgentStreamResponse
+    """Test the streaming response functionality with a mocked Anthropic stream."""
 
     # Create the agent with streaming enabled
     options = AnthropicAgentOptions(
@@ -495,38 +566,32 @@ async def test_handle_streaming_response():
 
     anthropic_agent = AnthropicAgent(options)
 
-    # Create a simple async generator function that mimics the behavior of handle_streaming_response
-    async def mock_streaming_response(input_data):
-        mock_content = [MagicMock(type="text", text="Final accumulated response")]
-        mock_final_message = MagicMock()
-        mock_final_message.content = mock_content
-        # First yield: text chunk with no final_message
-        yield AgentStreamResponse(text="Streaming chunk 1", final_message=None)
-        yield AgentStreamResponse(text="Streaming chunk 2", final_message=None)
-        yield AgentStreamResponse(text="", final_message=mock_final_message)
+    mock_content = [MagicMock(type="text", text="Final accumulated response")]
+    anthropic_agent.client = MagicMock()
+    anthropic_agent.client.messages.stream = MagicMock(
+        return_value=MockAnthropicStream(["Streaming chunk 1", "Streaming chunk 2"], mock_content)
+    )
 
-    # Patch the handle_streaming_response method
-    with patch.object(anthropic_agent, 'handle_streaming_response', return_value=mock_streaming_response({})):
-        # Call process_request which will use our mocked handle_streaming_response
-        response_generator = await anthropic_agent.process_request(
-            'Test prompt', 'user', 'session', [], {}
-        )
+    # Call process_request which will stream from the mocked client
+    response_generator = await anthropic_agent.process_request(
+        'Test prompt', 'user', 'session', [], {}
+    )
 
-        # Collect all responses
-        responses = []
-        async for response in response_generator:
-            responses.append(response)
+    # Collect all responses
+    responses = []
+    async for response in response_generator:
+        responses.append(response)
 
-        # Verify we got the expected pattern of responses
-        assert len(responses) == 3
-        assert responses[0].text == "Streaming chunk 1"
-        assert responses[0].final_message is None
+    # Verify we got the expected pattern of responses
+    assert len(responses) == 3
+    assert responses[0].text == "Streaming chunk 1"
+    assert responses[0].final_message is None
 
-        assert responses[1].text == "Streaming chunk 2"
-        assert responses[1].final_message is None
+    assert responses[1].text == "Streaming chunk 2"
+    assert responses[1].final_message is None
 
-        assert responses[2].text == ""
-        assert responses[2].final_message.content[0]["text"] == "Final accumulated response"
+    assert responses[2].text == ""
+    assert responses[2].final_message.content[0]["text"] == "Final accumulated response"
 
 
 @pytest.mark.asyncio
@@ -703,8 +768,6 @@ async def test_handle_streaming_response_implementation():
 @pytest.mark.asyncio
 async def test_handle_streaming_with_tool_use():
     """Test the streaming response with tool usage."""
-    from multi_agent_orchestrator.agents.anthropic_agent import AgentStreamResponse
-
     # Create agent with streaming enabled
     options = AnthropicAgentOptions(
         api_key='test-api-key',
@@ -723,29 +786,12 @@ async def test_handle_streaming_with_tool_use():
     tool_response = {"role": "tool", "content": "Tool response"}
     anthropic_agent._process_tool_block = AsyncMock(return_value=tool_response)
 
-    # First response generator - contains toolUse
-    async def stream_generator_with_tool():
-        # Regular chunks
-        yield AgentStreamResponse(text="Streaming with tool", final_message=None)
-
-        mock_content = [MagicMock(type="tool_use", text="Final accumulated response")]
-        mock_final_message = MagicMock()
-        mock_final_message.content = mock_content
-        yield AgentStreamResponse(text="", final_message=mock_final_message)
-
-    # Second response generator - no toolUse
-    async def stream_generator_final():
-        yield AgentStreamResponse(text="Final streaming", final_message=None)
-
-        mock_content = [MagicMock(type="text", text="Final accumulated response")]
-        mock_final_message = MagicMock()
-        mock_final_message.content = mock_content
-        yield AgentStreamResponse(text="", final_message=mock_final_message)
-
-    # Mock handle_streaming_response to return our generators
-    anthropic_agent.handle_streaming_response = MagicMock(
-        side_effect=[stream_generator_with_tool(), stream_generator_final()]
-    )
+    # First stream contains toolUse, the second one does not
+    anthropic_agent.client = MagicMock()
+    anthropic_agent.client.messages.stream = MagicMock(side_effect=[
+        MockAnthropicStream(["Streaming with tool"], [MagicMock(type="tool_use", text="Final accumulated response")]),
+        MockAnthropicStream(["Final streaming"], [MagicMock(type="text", text="Final accumulated response")])
+    ])
 
     # Call _handle_streaming
     input_data = {"messages": [{"role": "user", "content": "Test message"}]}
@@ -764,8 +810,576 @@ async def test_handle_streaming_with_tool_use():
     assert responses[1].final_message is None
     assert responses[2].final_message.content[0]["text"] == "Final accumulated response"
 
+    # Both rounds read the Anthropic stream directly
+    assert anthropic_agent.client.messages.stream.call_count == 2
+
     # Verify _process_tool_block was called with the right parameters
     anthropic_agent._process_tool_block.assert_called_once()
 
     # Verify the messages list was updated with the tool response
-    assert input_data["messages"][-1] == tool_response
\ No newline at end of file
+    assert input_data["messages"][-1] == tool_response
+
+def test_replace_placeholders():
+    variables = {'name': 'Claude', 'skills': ['- one', '- two']}
+
+    assert AnthropicAgent.replace_placeholders("No placeholders here", variables) == "No placeholders here"
+    assert AnthropicAgent.replace_placeholders("Hi {{name}}", variables) == "Hi Claude"
+    assert AnthropicAgent.replace_placeholders("{{skills}}", variables) == "- one\n- two"
+    assert AnthropicAgent.replace_placeholders("Keep {{missing}}", variables) == "Keep {{missing}}"
+
+@pytest.mark.asyncio
+async def test_system_prompt_is_rendered_once():
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        custom_system_prompt={
+            'template': "Prompt with {{variable}}",
+            'variables': {'variable': 'value'}
+        }
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    from multi_agent_orchestrator.agents import anthropic_agent as anthropic_agent_module
+
+    with patch.object(anthropic_agent_module, '_render_template', wraps=anthropic_agent_module._render_template) as mock_replace:
+        assert await anthropic_agent._prepare_system_prompt("First query") == "Prompt with value"
+        assert await anthropic_agent._prepare_system_prompt("Second query") == "Prompt with value"
+        mock_replace.assert_not_called()
+
+        anthropic_agent.set_system_prompt(variables={'variable': 'other value'})
+        assert await anthropic_agent._prepare_system_prompt("Third query") == "Prompt with other value"
+        mock_replace.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_retriever_cache():
+    mock_retriever = MagicMock(spec=Retriever)
+    mock_retriever.retrieve_and_combine_results = AsyncMock(side_effect=lambda text: f"Context for {text}")
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        retriever=mock_retriever,
+        retriever_cache_max_entries=2,
+        use_prompt_cache=False
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    assert "Context for query 1" in await anthropic_agent._prepare_system_prompt("query 1")
+    assert "Context for query 1" in await anthropic_agent._prepare_system_prompt("query 1")
+    assert mock_retriever.retrieve_and_combine_results.call_count == 1
+    assert anthropic_agent.retriever_cache_hits == 1
+    assert anthropic_agent.retriever_cache_misses == 1
+
+    # Oldest entry is evicted once the cache is full
+    await anthropic_agent._prepare_system_prompt("query 2")
+    await anthropic_agent._prepare_system_prompt("query 3")
+    await anthropic_agent._prepare_system_prompt("query 1")
+    assert mock_retriever.retrieve_and_combine_results.call_count == 4
+
+@pytest.mark.asyncio
+async def test_retriever_cache_ttl():
+    mock_retriever = MagicMock(spec=Retriever)
+    mock_retriever.retrieve_and_combine_results = AsyncMock(return_value="Retrieved context")
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        retriever=mock_retriever,
+        retriever_cache_max_entries=10,
+        retriever_cache_ttl=60
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    with patch('multi_agent_orchestrator.agents.anthropic_agent.time.monotonic', side_effect=[0, 30, 100, 100]):
+        await anthropic_agent._prepare_system_prompt("Test query")
+        await anthropic_agent._prepare_system_prompt("Test query")
+        await anthropic_agent._prepare_system_prompt("Test query")
+
+    assert mock_retriever.retrieve_and_combine_results.call_count == 2
+    assert anthropic_agent.retriever_cache_hits == 1
+
+@pytest.mark.asyncio
+async def test_retriever_semantic_cache():
+    mock_retriever = MagicMock(spec=Retriever)
+    mock_retriever.retrieve_and_combine_results = AsyncMock(return_value="Retrieved context")
+
+    embeddings = {
+        "What is the weather?": [1.0, 0.0, 0.0],
+        "How is the weather?": [0.99, 0.02, 0.0],
+        "Tell me a joke": [0.0, 0.0, 1.0],
+    }
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        retriever=mock_retriever,
+        semantic_cache=SemanticCache(dimensions=3, embedding_function=embeddings.get, seed=42),
+        use_prompt_cache=False
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    assert "Retrieved context" in await anthropic_agent._prepare_system_prompt("What is the weather?")
+    assert "Retrieved context" in await anthropic_agent._prepare_system_prompt("How is the weather?")
+    mock_retriever.retrieve_and_combine_results.assert_called_once_with("What is the weather?")
+
+    await anthropic_agent._prepare_system_prompt("Tell me a joke")
+    assert mock_retriever.retrieve_and_combine_results.call_count == 2
+    assert anthropic_agent.semantic_cache.hits == 1
+
+@pytest.mark.asyncio
+async def test_retriever_cache_ttl_with_semantic_cache():
+    mock_retriever = MagicMock(spec=Retriever)
+    mock_retriever.retrieve_and_combine_results = AsyncMock(side_effect=["v1", "v2"])
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        retriever=mock_retriever,
+        retriever_cache_max_entries=10,
+        retriever_cache_ttl=60,
+        semantic_cache=SemanticCache(dimensions=3, embedding_function=lambda text: [1.0, 0.0, 0.0], seed=42),
+        use_prompt_cache=False
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    # both caches read the same clock, time.monotonic is patched on the shared time module
+    now = [1000]
+    with patch('multi_agent_orchestrator.agents.anthropic_agent.time.monotonic', side_effect=lambda: now[0]):
+        assert (await anthropic_agent._prepare_system_prompt("Test query")).endswith("v1")
+        now[0] = 5000
+        assert (await anthropic_agent._prepare_system_prompt("Test query")).endswith("v2")
+
+    assert mock_retriever.retrieve_and_combine_results.call_count == 2
+    assert anthropic_agent.semantic_cache.hits == 0
+
+@pytest.mark.asyncio
+async def test_handle_single_response_runs_off_event_loop():
+    import threading
+
+    calling_threads = []
+    mock_client = MagicMock()
+    mock_client.messages.create.side_effect = lambda **kwargs: calling_threads.append(threading.current_thread()) or MagicMock()
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent"
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    anthropic_agent.client = mock_client
+
+    await anthropic_agent.handle_single_response({"messages": []})
+
+    mock_client.messages.create.assert_called_once_with(messages=[])
+    assert calling_threads[0] is not threading.current_thread()
+
+def test_prepare_session_conversation():
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent"
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    history = [
+        ConversationMessage(role=ParticipantRole.USER.value, content=[{"text": "User message"}]),
+        ConversationMessage(role=ParticipantRole.ASSISTANT.value, content=[{"text": "Assistant response"}])
+    ]
+
+    messages = anthropic_agent._prepare_session_conversation("New message", "user", "session", history)
+    assert messages == anthropic_agent._prepare_conversation("New message", history)
+
+    # Only the messages appended since the previous turn are converted
+    history = history + [
+        ConversationMessage(role=ParticipantRole.USER.value, content=[{"text": "New message"}]),
+        ConversationMessage(role=ParticipantRole.ASSISTANT.value, content=[{"text": "Second response"}])
+    ]
+    with patch.object(AnthropicAgent, '_to_claude_message', wraps=AnthropicAgent._to_claude_message) as mock_convert:
+        messages = anthropic_agent._prepare_session_conversation("Third message", "user", "session", history)
+        assert mock_convert.call_count == 4  # two boundary checks and two new messages
+
+    assert messages == anthropic_agent._prepare_conversation("Third message", history)
+
+    # A trimmed history no longer matches the cached messages and is converted again
+    trimmed_history = history[2:]
+    messages = anthropic_agent._prepare_session_conversation("Fourth message", "user", "session", trimmed_history)
+    assert messages == anthropic_agent._prepare_conversation("Fourth message", trimmed_history)
+
+    # Sessions are cached independently
+    messages = anthropic_agent._prepare_session_conversation("Hello", "user", "other-session", [])
+    assert messages == [{"role": "user", "content": "Hello"}]
+
+def test_build_input_does_not_share_payload():
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        inference_config={'maxTokens': 500},
+        use_prompt_cache=False
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    first_input = anthropic_agent._build_input([{"role": "user", "content": "First"}], "First prompt")
+    second_input = anthropic_agent._build_input([{"role": "user", "content": "Second"}], "Second prompt")
+
+    assert first_input is not second_input
+    assert first_input["max_tokens"] == 500
+    assert first_input["messages"] == [{"role": "user", "content": "First"}]
+    assert first_input["system"] == "First prompt"
+    assert second_input["messages"] == [{"role": "user", "content": "Second"}]
+    assert "messages" not in anthropic_agent._base_payload
+
+def test_tool_config_is_formatted_once():
+    mock_agent_tools = MagicMock(spec=AgentTools)
+    mock_agent_tools.to_claude_format.return_value = [{"name": "test_function"}]
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        tool_config={"tool": mock_agent_tools}
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    messages = [{"role": "user", "content": "Test message"}]
+
+    assert anthropic_agent._build_input(messages, "prompt")["tools"] == [{"name": "test_function"}]
+    assert anthropic_agent._build_input(messages, "prompt")["tools"] == [{"name": "test_function"}]
+    mock_agent_tools.to_claude_format.assert_called_once()
+
+    # Tools modified in place are formatted again after a refresh
+    mock_agent_tools.to_claude_format.return_value = [{"name": "other_function"}]
+    anthropic_agent.refresh_tool_cache()
+    assert anthropic_agent._build_input(messages, "prompt")["tools"] == [{"name": "other_function"}]
+
+    # Replacing the tool config invalidates the cache
+    other_tools = MagicMock(spec=AgentTools)
+    other_tools.to_claude_format.return_value = [{"name": "replaced_function"}]
+    anthropic_agent.tool_config = {"tool": other_tools}
+    assert anthropic_agent._build_input(messages, "prompt")["tools"] == [{"name": "replaced_function"}]
+    assert mock_agent_tools.to_claude_format.call_count == 2
+
+@pytest.mark.asyncio
+async def test_handle_single_response_ignores_other_tool_block_types():
+    response = MagicMock()
+    response.content = [MagicMock(type="server_tool_use"), MagicMock(type="text", text="Final response")]
+    response.content[0].text = "Searching"
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        tool_config={"tool": MagicMock(spec=AgentTools)}
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    anthropic_agent.handle_single_response = AsyncMock(return_value=response)
+    anthropic_agent._process_tool_block = AsyncMock()
+
+    await anthropic_agent._handle_single_response_loop({"messages": []}, [], 3)
+
+    anthropic_agent.handle_single_response.assert_called_once()
+    anthropic_agent._process_tool_block.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_handle_streaming_response_rechunks_large_events():
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        streaming=True,
+        stream_rechunk_threshold=8,
+        stream_rechunk_size=4,
+        stream_rechunk_delay=0
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    anthropic_agent.callbacks = MagicMock()
+
+    class MockStream:
+        def __init__(self):
+            self.events = iter([
+                type('Event', (), {'type': 'text', 'text': 'short'}),
+                type('Event', (), {'type': 'text', 'text': 'a large mega-chunk'}),
+            ])
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            pass
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            try:
+                return next(self.events)
+            except StopIteration:
+                raise StopAsyncIteration
+
+        async def get_final_message(self):
+            return MagicMock(content=[{"text": "short" + "a large mega-chunk"}])
+
+    anthropic_agent.client = MagicMock()
+    anthropic_agent.client.messages.stream = MagicMock(return_value=MockStream())
+
+    with patch('multi_agent_orchestrator.agents.anthropic_agent.asyncio.sleep', new_callable=AsyncMock) as mock_sleep:
+        responses = [chunk async for chunk in anthropic_agent.handle_streaming_response({"messages": []})]
+
+    texts = [response.text for response in responses if response.final_message is None]
+    assert texts == ["short", "a la", "rge ", "mega", "-chu", "nk"]
+    assert mock_sleep.await_count == 4
+    assert anthropic_agent.callbacks.on_llm_new_token.call_count == 6
+
+def test_build_input_prompt_cache():
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent"
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    history_message = {"role": "assistant", "content": "Previous answer"}
+    last_message = {"role": "user", "content": "New question"}
+    messages = [history_message, last_message]
+
+    input_data = anthropic_agent._build_input(messages, "Test system prompt")
+
+    assert input_data["system"] == [{"type": "text", "text": "Test system prompt", "cache_control": {"type": "ephemeral"}}]
+    assert input_data["messages"] is not messages
+    assert input_data["messages"][0] is history_message
+    assert input_data["messages"][1] == {
+        "role": "user",
+        "content": [{"type": "text", "text": "New question", "cache_control": {"type": "ephemeral"}}]
+    }
+    # the caller's list and messages are left untouched
+    assert messages == [history_message, last_message]
+    assert last_message == {"role": "user", "content": "New question"}
+
+    # Block content keeps its blocks, the breakpoint goes on the last one
+    block_message = {"role": "user", "content": [{"type": "text", "text": "one"}, {"type": "text", "text": "two"}]}
+    assert AnthropicAgent._with_cache_control(block_message)["content"] == [
+        {"type": "text", "text": "one"},
+        {"type": "text", "text": "two", "cache_control": {"type": "ephemeral"}}
+    ]
+
+    anthropic_agent.use_prompt_cache = False
+    messages = [{"role": "user", "content": "New question"}]
+    input_data = anthropic_agent._build_input(messages, "Test system prompt")
+    assert input_data["system"] == "Test system prompt"
+    assert input_data["messages"] == [{"role": "user", "content": "New question"}]
+
+@pytest.mark.asyncio
+async def test_process_request_starts_retrieval_before_conversation():
+    events = []
+
+    async def retrieve(text):
+        events.append("retrieval started")
+        await asyncio.sleep(0)
+        events.append("retrieval done")
+        return "Retrieved context"
+
+    mock_retriever = MagicMock(spec=Retriever)
+    mock_retriever.retrieve_and_combine_results = AsyncMock(side_effect=retrieve)
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        retriever=mock_retriever
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    anthropic_agent._process_with_strategy = AsyncMock(return_value="response")
+
+    prepare_conversation = anthropic_agent._prepare_session_conversation
+    def record_conversation(*args):
+        events.append("conversation prepared")
+        return prepare_conversation(*args)
+    anthropic_agent._prepare_session_conversation = record_conversation
+
+    assert await anthropic_agent.process_request('Test prompt', 'user', 'session', [], {}) == "response"
+    assert events == ["retrieval started", "conversation prepared", "retrieval done"]
+
+    input_data = anthropic_agent._process_with_strategy.call_args[0][1]
+    assert input_data["system"][1]["text"].endswith("Retrieved context")
+    # tool rounds are appended to the conversation the tool handlers receive
+    assert anthropic_agent._process_with_strategy.call_args[0][2] is input_data["messages"]
+
+@pytest.mark.asyncio
+async def test_process_request_cancellation_cancels_retrieval():
+    retrieval_cancelled = asyncio.Event()
+
+    async def retrieve(text):
+        try:
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            retrieval_cancelled.set()
+            raise
+
+    mock_retriever = MagicMock(spec=Retriever)
+    mock_retriever.retrieve_and_combine_results = AsyncMock(side_effect=retrieve)
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        retriever=mock_retriever
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    request = asyncio.create_task(anthropic_agent.process_request('Test prompt', 'user', 'session', [], {}))
+    # let the request start the retrieval and yield
+    await asyncio.sleep(0)
+    request.cancel()
+
+    with pytest.raises(asyncio.CancelledError):
+        await request
+    await asyncio.wait_for(retrieval_cancelled.wait(), 1)
+
+@pytest.mark.asyncio
+async def test_tool_handler_follows_tool_config():
+    mock_agent_tools = MagicMock(spec=AgentTools)
+    mock_agent_tools.tool_handler = AsyncMock(return_value={"role": "user", "content": "AgentTools response"})
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        tool_config={"tool": mock_agent_tools}
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    llm_response = MagicMock()
+
+    assert await anthropic_agent._process_tool_block(llm_response, []) == {"role": "user", "content": "AgentTools response"}
+
+    # A handler added in place is used on the next call
+    custom_handler = AsyncMock(return_value={"role": "user", "content": "Custom response"})
+    anthropic_agent.tool_config['useToolHandler'] = custom_handler
+    assert await anthropic_agent._process_tool_block(llm_response, []) == {"role": "user", "content": "Custom response"}
+    custom_handler.assert_called_once_with(llm_response, [])
+    mock_agent_tools.tool_handler.assert_called_with(AgentProviderType.ANTHROPIC.value, llm_response, [])
+
+    # Replacing the tool config resolves its AgentTools again
+    other_tools = MagicMock(spec=AgentTools)
+    other_tools.tool_handler = AsyncMock(return_value={"role": "user", "content": "Other response"})
+    anthropic_agent.tool_config = {"tool": other_tools}
+    assert await anthropic_agent._process_tool_block(llm_response, []) == {"role": "user", "content": "Other response"}
+
+@pytest.mark.asyncio
+async def test_tool_recursion_stops_when_calls_are_spent():
+    tool_response = MagicMock()
+    tool_response.content = [MagicMock(type="text", text="Calling tool"), MagicMock(type="tool_use")]
+
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        tool_config={"tool": MagicMock(spec=AgentTools)}
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    anthropic_agent.handle_single_response = AsyncMock(return_value=tool_response)
+    anthropic_agent._process_tool_block = AsyncMock(return_value={"role": "user", "content": "Tool result"})
+
+    response = await anthropic_agent._handle_single_response_loop({"messages": []}, [], 3)
+
+    # 3 calls for 2 tool rounds, the last tool use is not executed
+    assert anthropic_agent.handle_single_response.call_count == 3
+    assert anthropic_agent._process_tool_block.call_count == 2
+    assert response.content[0]["text"] == "Calling tool"
+
+    # A budget of 0 still performs the request
+    anthropic_agent.handle_single_response.reset_mock()
+    await anthropic_agent._handle_single_response_loop({"messages": []}, [], 0)
+    anthropic_agent.handle_single_response.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_streaming_tool_recursion_with_no_budget():
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        streaming=True
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+
+    anthropic_agent.client = MagicMock()
+    anthropic_agent.client.messages.stream = MagicMock(
+        return_value=MockAnthropicStream(["Final"], [MagicMock(type="text", text="Final response")])
+    )
+
+    responses = [response async for response in await anthropic_agent._handle_streaming({"messages": []}, [], 0)]
+
+    assert len(responses) == 2
+    assert responses[-1].final_message.content[0]["text"] == "Final response"
+
+def test_compiled_template_is_reused():
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        custom_system_prompt={
+            'template': "Hi {{name}}, {{skills}} {{missing}}",
+            'variables': {'name': 'Claude', 'skills': ['- one', '- two']}
+        }
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    assert anthropic_agent.system_prompt == "Hi Claude, - one\n- two {{missing}}"
+
+    with patch('multi_agent_orchestrator.agents.anthropic_agent._compile_template') as mock_compile:
+        anthropic_agent.set_system_prompt(variables={'name': 'Agent', 'missing': 'found'})
+        mock_compile.assert_not_called()
+    assert anthropic_agent.system_prompt == "Hi Agent, {{skills}} found"
+
+    anthropic_agent.set_system_prompt("Bye {{name}}")
+    assert anthropic_agent.system_prompt == "Bye Agent"
+
+@pytest.mark.asyncio
+async def test_streaming_tool_budget_spent_on_tool_use_only_response():
+    options = AnthropicAgentOptions(
+        api_key='test-api-key',
+        name="TestAgent",
+        description="A test agent",
+        streaming=True,
+        tool_config={
+            "tool": MagicMock(spec=AgentTools),
+            "toolMaxRecursions": 2
+        }
+    )
+
+    anthropic_agent = AnthropicAgent(options)
+    anthropic_agent._process_tool_block = AsyncMock(return_value={"role": "user", "content": "Tool result"})
+
+    def tool_use_stream():
+        return MockAnthropicStream([], [ToolUseBlock(id="tool_1", name="lookup", input={}, type="tool_use")])
+
+    anthropic_agent.client = MagicMock()
+    anthropic_agent.client.messages.stream = MagicMock(side_effect=[tool_use_stream(), tool_use_stream()])
+
+    input_data = {"messages": [{"role": "user", "content": "Test message"}]}
+    responses = [response async for response in await anthropic_agent._handle_streaming(input_data, input_data["messages"], 2)]
+
+    assert anthropic_agent.client.messages.stream.call_count == 2
+    anthropic_agent._process_tool_block.assert_called_once()
+    assert len(responses) == 1
+    assert responses[0].final_message.content == [{"text": ""}]
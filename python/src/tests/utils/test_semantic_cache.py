@@ -0,0 +1,77 @@
+import pytest
+from unittest.mock import patch
+from multi_agent_orchestrator.utils import SemanticCache
+
+def test_semantic_cache_get_similar_vector():
+    cache = SemanticCache(dimensions=3, seed=42)
+    cache.put([1.0, 0.0, 0.0], "cached value")
+
+    assert cache.get([1.0, 0.0, 0.0]) == "cached value"
+    assert cache.get([0.99, 0.01, 0.0]) == "cached value"
+    assert cache.get([0.0, 1.0, 0.0]) is None
+    assert cache.hits == 2
+    assert cache.misses == 1
+
+def test_semantic_cache_threshold():
+    cache = SemanticCache(dimensions=2, num_tables=1, num_planes=1, seed=1)
+    cache.put([1.0, 0.0], "cached value")
+
+    # cos(45°) is ~0.707, below the default threshold
+    assert cache.get([1.0, 1.0]) is None
+    assert cache.get([2.0, 0.0], threshold=0.5) == "cached value"
+
+def test_semantic_cache_eviction():
+    cache = SemanticCache(dimensions=2, max_entries=2, seed=42)
+    cache.put([1.0, 0.0], "first")
+    cache.put([0.0, 1.0], "second")
+    cache.put([-1.0, 0.0], "third")
+
+    assert len(cache) == 2
+    assert cache.get([1.0, 0.0]) is None
+    assert cache.get([0.0, 1.0]) == "second"
+    assert cache.get([-1.0, 0.0]) == "third"
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.get([0.0, 1.0]) is None
+
+def test_semantic_cache_max_age():
+    cache = SemanticCache(dimensions=2, seed=42)
+
+    with patch('multi_agent_orchestrator.utils.semantic_cache.time.monotonic', return_value=0):
+        cache.put([1.0, 0.0], "cached value")
+
+    with patch('multi_agent_orchestrator.utils.semantic_cache.time.monotonic', return_value=30):
+        assert cache.get([1.0, 0.0], max_age=60) == "cached value"
+        assert cache.get([1.0, 0.0]) == "cached value"
+
+    with patch('multi_agent_orchestrator.utils.semantic_cache.time.monotonic', return_value=100):
+        assert cache.get([1.0, 0.0], max_age=60) is None
+    # expired entries are removed
+    assert len(cache) == 0
+
+def test_semantic_cache_invalid_vectors():
+    with pytest.raises(ValueError):
+        SemanticCache(dimensions=0)
+
+    cache = SemanticCache(dimensions=2)
+    with pytest.raises(ValueError):
+        cache.put([1.0, 0.0, 0.0], "value")
+    with pytest.raises(ValueError):
+        cache.get([1.0])
+
+    # Zero vectors have no direction and are never cached
+    cache.put([0.0, 0.0], "value")
+    assert len(cache) == 0
+    assert cache.get([0.0, 0.0]) is None
+
+@pytest.mark.asyncio
+async def test_semantic_cache_embed():
+    async def async_embed(text):
+        return [float(len(text)), 1.0]
+
+    assert await SemanticCache(dimensions=2, embedding_function=lambda text: [1.0, 0.0]).embed("text") == [1.0, 0.0]
+    assert await SemanticCache(dimensions=2, embedding_function=async_embed).embed("text") == [4.0, 1.0]
+
+    with pytest.raises(ValueError, match="An embedding function is required"):
+        await SemanticCache(dimensions=2).embed("text")